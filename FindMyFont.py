@@ -10,18 +10,31 @@ Currently, it only works with .ttf files and will ignore .otf
 Summary:
     - Uses a simple api request to get the fonts sorted by popularity
     - Converts the .ttf file type into a shapely polygon object
-    - Compares both shapely polygons and finds the difference, storing the top matches in a scoreboard
+    - Draws the polygons onto a grid of pixels, so they can be compared as bitmaps
+    - Compares both bitmaps and finds the difference, storing the top matches in a scoreboard
     - The lower the difference percentage, the better the match is
 """
 
 from urllib.request import urlopen
-import urllib.request
+import urllib3
+import io
 import json
-from fontTools.ttLib import TTFont
-from fontTools.pens.svgPathPen import SVGPathPen
-from svgpath2mpl import parse_path as mpl_parse_path
-from shapely.geometry import Polygon
-import shapely.affinity as affinity
+import heapq
+import hashlib
+import os
+import sys
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fontTools.ttLib import TTFont, TTLibError
+import numpy as np
+import shapely
+try:
+    from numba import njit
+except ImportError:
+    # Without numba the flattening functions simply run as regular Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 import constants
 
 
@@ -40,6 +53,12 @@ These are the settings that can be changed to find the alternative.
         
     check_chars: These are the characters we will use to find the free alternative.
         Enter the most unique characters for the best match
+        
+    skip_categories: Google Fonts categories that are skipped without downloading them.
+        Display fonts are skipped by default since they almost never match a regular text font
+        
+    cache_dir & cache_age: Downloaded fonts and the Google Fonts list are saved in cache_dir, so 
+        searching again doesn't download them again. The font list is refreshed after cache_age seconds
     
 """
 ###SETTINGS###
@@ -63,34 +82,129 @@ upper_bound = 50
 # These are the characters we will match up to find the free alternative
 check_chars = ['A','B','C']
 
-# Initialize ranking scoreboard at the worse possible percentage of difference.
-# i.e. 100 corresponds to the two not overlapping at all
-ranking=[[100,""],[100,""],[100,""],[100,""],[100,""]]
+# Google Fonts categories we won't bother downloading
+skip_categories = ['display']
+
+# Where downloaded fonts are kept, and how long to keep using the saved font list (1 day)
+cache_dir = Path('.fontcache')
+cache_age = 24*60*60
+
+# Number of fonts to keep on the ranking scoreboard
+ranking_size = 5
+
+# Initialize an empty ranking scoreboard. It is kept as a heap of (-difference, url) pairs,
+# so the worst match on the scoreboard is always the first one to be removed
+ranking=[]
 
 #########
 
+# Number of straight line steps used to flatten each curve in a glyph
+CURVE_STEPS = 8
+
+"""
+Flattens the quadratic curve from p0 to p2, with p1 as its control point, into n_steps points.
+The start point p0 is not included since the previous segment already ends there.
+
+Compiled with numba since it runs for every curve of every letter in every font.
+nogil lets several fonts be flattened at the same time in the conversion threads.
 """
-Checks and updates the scoreboard.
+@njit(cache=True, fastmath=True, nogil=True)
+def flatten_quadratic(p0, p1, p2, n_steps):
+    out = np.empty((n_steps, 2), dtype=np.float64)
+    for k in range(n_steps):
+        t = (k+1)/n_steps
+        mt = 1-t
+        out[k, 0] = mt*mt*p0[0] + 2*mt*t*p1[0] + t*t*p2[0]
+        out[k, 1] = mt*mt*p0[1] + 2*mt*t*p1[1] + t*t*p2[1]
+    return out
+
 """
-def addScore(array, score, url):
-    j=0
-    i=0
-    # Check throughout the entire array
-    for i in range(array.__len__()):
-        # Stop when our new value is better than the one stored
-        if score <= array[i][0]:
-            j=array.__len__()-1
+Takes the points of a single TrueType contour and turns it into a closed ring of points.
+
+TrueType contours are made of on-curve points and off-curve control points. Two off-curve
+points in a row have an implied on-curve point halfway between them, and a contour with 
+no on-curve points at all starts halfway between its last and first points.
+"""
+@njit(cache=True, fastmath=True, nogil=True)
+def flatten_contour(points, on_curve, n_steps):
+    n = len(points)
+    out = np.empty(((n+1)*n_steps + 1, 2), dtype=np.float64)
+    
+    # Find an on-curve point to start from
+    start = -1
+    for i in range(n):
+        if on_curve[i]:
+            start = i
             break
-    # Shift all elements down to fit our new score
-    while j > i:
-        array[j][0] = array[j-1][0]
-        array[j][1] = array[j-1][1]
-        j = j-1
-    # Store the new score
-    if score <=array[i][0]:
-        array[i][0] = score
-        array[i][1] = url   
+    if start >= 0:
+        begin = points[start].copy()
+        first = start+1
+    else:
+        begin = (points[n-1] + points[0])/2
+        first = 0
+    out[0] = begin
+    m = 1
+    
+    # Walk around the contour once, ending back on the starting point
+    current = begin.copy()
+    off = np.empty(2, dtype=np.float64)
+    has_off = False
+    for k in range(first, first+n):
+        pt = points[k % n]
+        if on_curve[k % n]:
+            if has_off:
+                out[m:m+n_steps] = flatten_quadratic(current, off, pt, n_steps)
+                m += n_steps
+            else:
+                out[m] = pt
+                m += 1
+            current = pt.copy()
+            has_off = False
+        else:
+            if has_off:
+                mid = (off + pt)/2
+                out[m:m+n_steps] = flatten_quadratic(current, off, mid, n_steps)
+                m += n_steps
+                current = mid
+            off = pt.copy()
+            has_off = True
+    # Close a contour that had no on-curve points
+    if has_off:
+        out[m:m+n_steps] = flatten_quadratic(current, off, begin, n_steps)
+        m += n_steps
+    return out[:m]
+
+"""
+Unions a large number of shapes by first finding which of them overlap.
+
+An STRtree is used to find every pair of overlapping shapes, and the pairs are joined into
+groups. Each group is unioned on its own and the groups are then combined. The result is the
+same as a single unary_union of all the shapes.
+"""
+def unionGroups(shapes):
+    tree = shapely.STRtree(shapes)
+    left, right = tree.query(shapes, predicate="intersects")
     
+    # Join the overlapping pairs into groups, each shape points towards the first shape of its group
+    parent = list(range(len(shapes)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(left, right):
+        root_i = find(i)
+        root_j = find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    
+    # Union each group of overlapping shapes, then put the groups together
+    groups = {}
+    for i in range(len(shapes)):
+        groups.setdefault(find(i), []).append(shapes[i])
+    parts = [shapely.unary_union(group) for group in groups.values()]
+    return shapely.unary_union(parts)
+
 """
 Takes a fonttools TTFont object and converts it to a shapely Polygon
 If the font has extra shapes this combines them together all into one object.
@@ -100,135 +214,299 @@ Ex. in the letter 'o' ttfont2poly will erase the inner ring, and only use the
 outer ring for comparison.
 """
 def ttfont2poly(font, letter):
-    # Get the glyphset to see the letters
-    glyph_set = font.getGlyphSet()
+    # Get the specific letter from the glyf table
+    glyf = font['glyf']
+    glyph = glyf[letter]
+    
+    # Get the points of the letter, and whether each one is on the curve or a control point
+    coordinates, end_pts, flags = glyph.getCoordinates(glyf)
+    points = np.array(coordinates.array, dtype=np.float64).reshape(-1, 2)
+    on_curve = (np.frombuffer(flags, dtype=np.uint8) & 1).astype(np.bool_)
     
-    # Get the specific letter from the glyph set
-    glyph = font['glyf'][letter]
+    # Flatten the curves of every contour into straight lines
+    coords = []
+    start = 0
+    for end in end_pts:
+        # Skip stray points and lines, since they have no area
+        if end - start >= 2:
+            coords.append(flatten_contour(points[start:end+1], on_curve[start:end+1], CURVE_STEPS))
+        start = end+1
     
-    # Convet glyph to an svg
-    svg = SVGPathPen(None)
-    glyph.draw(svg, glyph_set)
+    # Letters with no outline (like a space) can't be compared, so treat them like a missing letter
+    if not coords:
+        raise KeyError(letter)
     
-    # Parse the svg into a path that Shapely can read using matplotlib
-    mpl_path = mpl_parse_path(svg.getCommands())
-    coords = mpl_path.to_polygons()
+    # Build all the shapes in a single call, using indices to tell Shapely which ring each point belongs to
+    indices = np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    shapes = shapely.polygons(shapely.linearrings(np.concatenate(coords), indices=indices))
     
-    # Union all shapes together, since some fonts have seperate strokes that we want to include
-    poly = Polygon(coords[0])
-    for i in range(coords.__len__()):         
-        poly = poly.union(Polygon(coords[i]))
+    # TrueType allows contours that cross themselves, which Shapely can't union.
+    # Repair just those shapes so the letter can still be compared
+    invalid = ~shapely.is_valid(shapes)
+    if invalid.any():
+        shapes[invalid] = shapely.make_valid(shapes[invalid])
+    
+    # Union all shapes together at once, since some fonts have seperate strokes that we want to include.
+    # Letters with lots of shapes are first split into groups of overlapping shapes
+    if len(shapes) > 32:
+        poly = unionGroups(shapes)
+    else:
+        poly = shapely.unary_union(shapes)
     return poly
 
+# Number of pixels along each side of the grid that letters are drawn on for comparison
+RASTER_SIZE = 128
+
+# Centers of every pixel in a 1x1 box, row by row
+_grid_x, _grid_y = np.meshgrid((np.arange(RASTER_SIZE) + 0.5)/RASTER_SIZE, (np.arange(RASTER_SIZE) + 0.5)/RASTER_SIZE)
+RASTER_GRID = np.stack([_grid_x.ravel(), _grid_y.ravel()], axis=1)
+
+"""
+Counts the filled pixels of bitmaps packed by load_polys, along the last axis
 """
-Calculates the x and y lengths of the bounding box enclosing the Polygon letter
+if hasattr(np, "bitwise_count"):
+    def countPixels(bits):
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+else:
+    def countPixels(bits):
+        return np.unpackbits(bits.view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+
 """
-def getPolyFactor(poly):
-    x = poly.bounds[2]- poly.bounds[0]
-    y = poly.bounds[3] - poly.bounds[1]
+Loads a font and converts each of the letters we want to match into a bitmap.
+
+Each letter is stretched to fit a RASTER_SIZE x RASTER_SIZE grid, so fonts of different sizes 
+get a fair comparison without having to rescale anything when they are compared. The bitmap 
+is packed into 64 bit integers, so two letters can be compared with a few bitwise operations.
+
+Returns a dictionary mapping every letter to its bitmap and its number of filled pixels, 
+so the work only has to be done once per font
+"""
+def load_polys(location, check_chars):
+    # Load the font as a TTFont object. Loading lazily means only the tables we use get decompiled,
+    # which is just glyf and the few tables it depends on, and only for the letters we ask for.
+    # fontNumber picks the first font if we are given a .ttc collection
+    font = TTFont(location, lazy=True, ignoreDecompileErrors=True, fontNumber=0)
+    
+    check_chars = list(check_chars)
+    shapes = np.array([ttfont2poly(font, i) for i in check_chars], dtype=object)
+    
+    # Get the bounding box of every letter in one call, as rows of (minx, miny, maxx, maxy)
+    bounds = shapely.bounds(shapes)
+    mins = bounds[:, None, :2]
+    sizes = bounds[:, None, 2:] - mins
     
-    return (x,y)
+    # Stretch the grid over each letter's bounding box and check which pixels are inside the letter
+    points = RASTER_GRID*sizes + mins
+    shapely.prepare(shapes)
+    bitmaps = shapely.contains_xy(shapes[:, None], points[..., 0], points[..., 1])
+    
+    # Pad each bitmap with empty pixels up to a whole number of 64 bit integers,
+    # so any RASTER_SIZE works. The extra pixels are never filled so they don't change the counts
+    bitmaps = np.pad(bitmaps, ((0, 0), (0, -bitmaps.shape[1] % 64)))
+    bits = np.packbits(bitmaps, axis=1).view(np.uint64)
+    counts = countPixels(bits)
+    return {i: (bits[n], counts[n]) for n, i in enumerate(check_chars)}
 
 """
-Calls functions to perform the differnce percentage comparison.
+Performs the difference percentage comparison between the user's letters and a list of
+fonts, all from load_polys. Returns the difference of every font in the list.
 
-This will also scale the fonts in the database, so the bounding boxes match the 
-first font. This is done in case the fonts are different font sizes, so this way 
-we get a fair comparison
+Every letter of every font is compared at once on their bitmaps, the pixels in both letters 
+are the intersection and the pixels in either letter are the union.
 
-    total stores the total average for every letter we used to match
-    count stores the number of letters
-    total/count gives us the overall percentage difference
+    keep: if given, only the best keep fonts need an exact difference. Since two letters can
+        never overlap more than the smaller area out of the larger one, the areas alone give 
+        the best difference a font could possibly get. Fonts that can't beat the current top 
+        matches skip the bitmap comparison and get a difference of infinity
 """
-def match(check_chars, location1, location2):
-    # Initialize variables
-    total = 0 # Stores the difference area of all letters
-    count = 0 # Used to calculate the average percentage
-    
-    # Load the fonts as a TTFont object
-    font1 =TTFont(location1, lazy=False)
-    font2 = TTFont(location2, lazy=False)
-   
-    # Perfom conversions and calculations on each letter the user wishes to match
-    for i in check_chars:
-        count = count+1
-        # Convert the fonts to 
-        poly1 = ttfont2poly(font1, i)
-        poly2 = ttfont2poly(font2, i)
-      
-        # Get factors to scale 2nd poly to first, so the sizes are the same for a fair comparison
-        x1,y1 = getPolyFactor(poly1)
-        x2,y2= getPolyFactor(poly2)
-        scale_poly2 = affinity.scale(poly2, xfact=(x1/x2), yfact=(y1/y2), origin=(0,0))
+def compareAll(polys1, candidates, keep=None):
+    # Line up the letters of the user's font with a row of letters for every font in the list
+    letters = list(polys1)
+    query = np.stack([polys1[i][0] for i in letters])
+    query_areas = np.array([polys1[i][1] for i in letters])
+    cand = np.empty((len(candidates),) + query.shape, dtype=np.uint64)
+    cand_areas = np.empty(cand.shape[:2])
+    for n, polys2 in enumerate(candidates):
+        for l, i in enumerate(letters):
+            cand[n, l], cand_areas[n, l] = polys2[i]
+    
+    def exact(rows):
+        # Count the pixels in both letters, the user's letters are repeated for each row
+        intersection_area = countPixels(query & cand[rows])
         
-        # Calculate the intersection and union
-        intersection = poly1.intersection(scale_poly2)
-        union = poly1.union(scale_poly2)
-               
         # Calculates the difference, and divides by union to get the percentage of 
-        # difference for a single letter, and adds it to total to account for multiple letters
-        total += (union.area - intersection.area)/union.area
-    # Calculates the overall average by divding the total number of difference
-    #  averages by the number of letters we used to compare
-    return (total/count)
+        # difference for each letter, then averages each row to get the overall percentage difference
+        # i.e. (union - intersection)/union = 1 - intersection/union
+        diffs = 1 - intersection_area/(query_areas + cand_areas[rows] - intersection_area)
+        return diffs.mean(axis=1)
+    
+    if keep is None or len(candidates) <= keep:
+        return exact(slice(None))
+    
+    # The best difference each font could get, if its smaller letter was completely inside the other
+    best_possible = 1 - (np.minimum(query_areas, cand_areas)/np.maximum(query_areas, cand_areas)).mean(axis=1)
+    order = np.argsort(best_possible)
+    scores = np.full(len(candidates), np.inf)
+    
+    # Score the most promising fonts first, then only the fonts that could still beat the worst of them
+    first = order[:keep]
+    scores[first] = exact(first)
+    rest = order[keep:]
+    rest = rest[best_possible[rest] < scores[first].max()]
+    if len(rest):
+        scores[rest] = exact(rest)
+    return scores
+
+"""
+Performs the difference percentage comparison between two sets of letters from load_polys
+"""
+def compare(polys1, polys2):
+    return compareAll(polys1, [polys2])[0]
+
+"""
+Calls functions to perform the difference percentage comparison between two font files
+"""
+def match(check_chars, location1, location2):
+    return compare(load_polys(location1, check_chars), load_polys(location2, check_chars))
 
 """
-Formats and prints the ranking scoreboard
+Converts the letters of a downloaded font into packed bitmaps.
+This is what runs in the conversion thread pool, so many fonts are converted at the same time
+"""
+def loadFontData(font_data, check_chars):
+    return load_polys(io.BytesIO(font_data), check_chars)
+
+"""
+Formats and prints the ranking scoreboard, from the best match to the worst
 """
 def printScore(array):
     print("\nYour Fonts are here:")
-    for i in range(array.__len__()):
-        print(f"{i+1}.  Difference: {array[i][0]:.2f}%\n\t{array[i][1]}")
-    pass
+    for i, (score, url) in enumerate(sorted(array, reverse=True)):
+        print(f"{i+1}.  Difference: {-score:.2f}%\n\t{url}")
  
+"""
+Downloads a font from the Google Fonts database straight into memory, using the shared
+connection pool so connections are reused instead of reconnecting for every font.
+Returns the url along with the font's bytes so the caller knows which font it got back
+"""
+def downloadFont(http, font_URL):
+    # Use the saved copy if we have downloaded this font before
+    location = cache_dir / (hashlib.sha1(font_URL.encode()).hexdigest() + ".ttf")
+    if location.exists():
+        return (font_URL, location.read_bytes())
+    
+    response = http.request("GET", font_URL)
+    if response.status == 200:
+        # Write to a temporary name first so an interrupted run never leaves half a font in the cache
+        partial = location.with_suffix(".part")
+        partial.write_bytes(response.data)
+        partial.replace(location)
+    return (font_URL, response.data)
+
+"""
+Gets the Google Fonts list from the api. The response is saved in the cache and reused 
+until it is older than cache_age, so searching again doesn't need to call the api
+"""
+def getFontList(url):
+    location = cache_dir / "index.json"
+    if location.exists() and time.time() - location.stat().st_mtime < cache_age:
+        return json.loads(location.read_bytes())
+    
+    # Get the json response
+    response = urlopen(url).read()
+    # Write to a temporary name first so an interrupted run never leaves half a list in the cache
+    partial = location.with_suffix(".part")
+    partial.write_bytes(response)
+    partial.replace(location)
+    return json.loads(response)
+
 """"
 Part of program that makes the api call, and function calls
 
-
+Downloads run in a thread pool since they are mostly waiting on the network, and each
+downloaded font is handed to a second thread pool to be converted. Shapely and the numba
+functions release the GIL while they work, so the threads can use every core without having
+to copy the fonts' letters between processes.
+Once every font is converted they are all compared in one go, and the scoreboard is
+only ever updated here on the main thread.
 """
 ####### MAIN #######
 
-# If user is providing us with two local fonts to compare, simply print out the number
-if local_font2 == True:
-    try:
-        print(f"Difference: {match(check_chars, location1, location2):.2f}%")
-    except:
-        print("Something went wrong. Also remember this only works for .ttf file types")
-else:        
-    # We will lookup the closest matching font in the Google Fonts database
-    
-    # Get the fonts sorted by popularity
-    url = f"https://www.googleapis.com/webfonts/v1/webfonts?key={API_KEY}&sort=popularity"
-
-    # Get the json response
-    response = urlopen(url)
+# Guarded so the settings and functions can be imported without starting a search
+if __name__ == "__main__":
+    # If user is providing us with two local fonts to compare, simply print out the number
+    if local_font2 == True:
+        try:
+            print(f"Difference: {match(check_chars, location1, location2):.2f}%")
+        except:
+            print("Something went wrong. Also remember this only works for .ttf file types")
+    else:        
+        # We will lookup the closest matching font in the Google Fonts database
+        
+        # Make sure we have the user's font that we will find an alternative to
+        if not os.path.isfile(location1):
+            print("Could not find font")
+            sys.exit(1)
+        
+        # Get the fonts sorted by popularity
+        url = f"https://www.googleapis.com/webfonts/v1/webfonts?key={API_KEY}&sort=popularity"
 
-    # Store JSON from url into data
-    data = json.loads(response.read())
-    
-    # Get the user's font that we will find an alternative to
-    try:
-        font1 = open(location1, "r")
-    except:
-        print("Could not find font")
+        # Store JSON from url into data, using the saved copy if it is recent enough
+        cache_dir.mkdir(exist_ok=True)
+        data = getFontList(url)
         
-    # Iterate through range of fonts we want to search
-    for fonts in range(lower_bound, upper_bound):
-        # retrieve font2 from the api
-        font_URL = data['items'][fonts]['files']['regular']
+        # Convert the user's font once, rather than for every font in the database
+        polys1 = load_polys(location1, check_chars)
+            
+        # Get the urls for the range of fonts we want to search
+        font_URLs = []
+        for item in data['items'][lower_bound:upper_bound]:
+            font_URL = item['files'].get('regular', "")
+            # Only .ttf files can be matched, so skip anything else before downloading it
+            if not font_URL.endswith('.ttf') or item.get('category') in skip_categories:
+                continue
+            font_URLs.append(font_URL)
         
-        # Get the second font frorm the api request
-        location2 = urllib.request.urlretrieve(font_URL)
-        # Print so the user can see which fonts it's looking through
-        print(font_URL) 
+        # Keep as many connections open as there are download threads
+        download_workers = 16
+        http = urllib3.PoolManager(maxsize=download_workers)
         
-        # Get the score and add the score the ranking scoreboard
-        try:
-            score = match(check_chars, location1, location2[0])
-            addScore(ranking, score*100, font_URL)
+        with ThreadPoolExecutor(max_workers=download_workers) as downloader, \
+             ThreadPoolExecutor(max_workers=os.cpu_count()) as matcher:
+            # Start downloading all the fonts at once
+            downloads = [downloader.submit(downloadFont, http, font_URL) for font_URL in font_URLs]
             
-        except: # Skips .otf files, or if theres an error with files
-            pass
-    # Print the ranking scoreboard
-    printScore(ranking)
-  
+            # As soon as a font finishes downloading, send it off to be converted
+            conversions = {}
+            for download in as_completed(downloads):
+                font_URL, font_data = download.result()
+                # Print so the user can see which fonts it's looking through
+                print(font_URL)
+                conversions[matcher.submit(loadFontData, font_data, check_chars)] = font_URL
+            
+            # Collect the letters of every font that could be converted
+            candidates = []
+            candidate_URLs = []
+            for result in as_completed(conversions):
+                try:
+                    candidates.append(result.result())
+                    candidate_URLs.append(conversions[result])
+                    
+                except (TTLibError, KeyError): # Skips fonts that can't be read, or that are missing a letter or have an empty one
+                    pass
+        
+        # Compare all the fonts at once, and add the scores to the ranking scoreboard
+        scores = compareAll(polys1, candidates, keep=ranking_size)
+        for score, font_URL in zip(scores, candidate_URLs):
+            # Skip fonts that were rejected without being compared
+            if np.isinf(score):
+                continue
+            entry = (-score*100, font_URL)
+            if len(ranking) < ranking_size:
+                heapq.heappush(ranking, entry)
+            # Once the scoreboard is full, a font only gets on by beating the worst match,
+            # so most fonts are turned away after a single comparison
+            elif entry > ranking[0]:
+                heapq.heapreplace(ranking, entry)
+        # Print the ranking scoreboard
+        printScore(ranking)